@@ -3,59 +3,37 @@ import json
 import argparse
 import os
 
+import numpy as np
+
+from camelot_numba import greedy_path, transition_scores, two_opt
 from camelot_rules import *
 from camelot_utilities import *
 
 # ------------------ Scoring ------------------ #
 
-MIX_SCORES = {
-    "perfect mix": 5.0,
-    "+1 mix": 4.0,
-    "-1 mix": 4.0,
-    "energy boost": 3.0,
-    "scale change": 3.0,
-    "diagonal mix": 2.0,
-    "mood shifter": 2.0,
-    "jaws mix": 1.0,
-    "non-harmonic": 0.0,
-    "unknown": 0.0,
-}
-
-def transition_score(song_a, song_b, weight_bpm=0.40):
-    """
-    BPM-FIRST scoring:
-    - BPM closeness is the PRIMARY factor.
-    - Harmonic strength still helps choose the best match within similar BPM.
-    """
-    key_a = song_a.get("key")
-    key_b = song_b.get("key")
-    bpm_a = song_a.get("bpm")
-    bpm_b = song_b.get("bpm")
-
-    # Harmonic score
-    mix_type = classify_mix_type(key_a, key_b)
-    harmonic = MIX_SCORES.get(mix_type, 0.0)
-
-    # BPM score: the closer the better (inverse penalty)
-    if bpm_a is None or bpm_b is None:
-        bpm_score = 0.0
-    else:
-        diff = abs(bpm_b - bpm_a)
-        bpm_score = max(0.0, 10.0 - diff)  # stronger weight
+# BPM-FIRST scoring (camelot_numba.transition_scores, bpm_first=True):
+# - BPM closeness is the PRIMARY factor.
+# - Harmonic strength still helps choose the best match within similar BPM.
+# WEIGHT_BPM is the share of the score given to BPM closeness.
+WEIGHT_BPM = 0.40
 
-    # Final score: BPM dominates + harmony refines
-    score = bpm_score * weight_bpm + harmonic * (1 - weight_bpm)
 
-    return score, mix_type
+def transition_score_matrix(bpms, keys, weight_bpm=WEIGHT_BPM):
+    """S[a, b] = transition score a → b for every pair of songs (float32)."""
+    return transition_scores(
+        bpms[:, None], keys[:, None], bpms[None, :], keys[None, :],
+        SCORE_TABLE, weight_bpm, True
+    ).astype(np.float32)
 
 
 # ------------------ BPM-FIRST PATH BUILDER ------------------ #
 
-def build_bpm_first_path(songs):
+def build_bpm_first_path(songs, use_two_opt=False):
     """
     BPM-FIRST strategy:
     1. Sort globally by BPM ascending.
     2. Inside close BPM groups, order harmonically using greedy selection.
+    3. Optionally (use_two_opt) refine the greedy path with 2-opt moves.
     """
 
     if not songs:
@@ -67,30 +45,16 @@ def build_bpm_first_path(songs):
         key=lambda s: (float("inf") if s.get("bpm") is None else s["bpm"])
     )
 
-    remaining = list(range(len(songs_sorted)))
-    path = []
-
-    # Start from the absolute lowest BPM song
-    current_idx = remaining.pop(0)
-    path.append(current_idx)
+    # Parse bpm/key once; the greedy loop only touches these parallel arrays
+    bpms, keys = precompute(songs_sorted)
 
+    # Start from the absolute lowest BPM song, then
     # 2) Greedy harmonic refinement, but BPM is already dominant
-    while remaining:
-        best_idx = None
-        best_score = float("-inf")
+    path = greedy_path(bpms, keys, SCORE_TABLE, WEIGHT_BPM, 0, True).tolist()
 
-        curr_song = songs_sorted[path[-1]]
-
-        for idx in remaining:
-            candidate = songs_sorted[idx]
-            score, mix_type = transition_score(curr_song, candidate)
-
-            if score > best_score:
-                best_score = score
-                best_idx = idx
-
-        path.append(best_idx)
-        remaining.remove(best_idx)
+    # 3) Optional 2-opt refinement over the full N×N score matrix
+    if use_two_opt:
+        path = two_opt(path, transition_score_matrix(bpms, keys)).tolist()
 
     return [songs_sorted[i] for i in path]
 
@@ -117,6 +81,11 @@ def main():
     )
     parser.add_argument("--input", required=True, help="Input JSON file")
     parser.add_argument("--output", required=False, help="Output JSON")
+    parser.add_argument(
+        "--two-opt",
+        action="store_true",
+        help="Refine the greedy order with 2-opt (better transitions, ~2x slower)"
+    )
 
     args = parser.parse_args()
 
@@ -137,7 +106,7 @@ def main():
         print(f"  → {len(missing)} songs skipped.")
 
     # BPM-first ordering
-    ordered = build_bpm_first_path(usable)
+    ordered = build_bpm_first_path(usable, use_two_opt=args.two_opt)
 
     # Clean output
     mixed_output = make_clean_output(ordered)
@@ -150,8 +119,7 @@ def main():
         output_path = base + "_mixed_bpm_first.json"
 
     # Save
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(mixed_output, f, indent=2, ensure_ascii=False)
+    write_json(output_path, mixed_output)
 
     print(f"\n✨ BPM-first mix saved → {output_path}")
     print(f"Tracks in mix: {len(mixed_output)}")
@@ -3,53 +3,36 @@ import json
 import argparse
 import os
 
+import numpy as np
+
+from camelot_numba import greedy_path, transition_scores, two_opt
 from camelot_rules import *
 from camelot_utilities import *
 
 # ------------------ Scoring ------------------ #
 
-MIX_SCORES = {
-    "perfect mix": 5.0,
-    "+1 mix": 4.0,
-    "-1 mix": 4.0,
-    "energy boost": 3.0,
-    "scale change": 3.0,
-    "diagonal mix": 2.0,
-    "mood shifter": 2.0,
-    "jaws mix": 1.0,
-    "non-harmonic": 0.0,
-    "unknown": 0.0,
-}
-
-def transition_score(song_a, song_b, weight_bpm=0.15):
-    """
-    Compute a global score for transition A → B.
-    - Strong weight for harmonic rule.
-    - Small penalty for big BPM jumps.
-    weight_bpm: higher = more BPM smoothing, lower = more harmonic-focused.
-    """
-    key_a = song_a.get("key")
-    key_b = song_b.get("key")
-    bpm_a = song_a.get("bpm")
-    bpm_b = song_b.get("bpm")
+# Harmonic-first scoring (camelot_numba.transition_scores, bpm_first=False):
+# - Strong weight for harmonic rule.
+# - Small penalty for big BPM jumps.
+# WEIGHT_BPM is the penalty per BPM of difference: higher = more BPM
+# smoothing, lower = more harmonic-focused.
+WEIGHT_BPM = 0.15
 
-    mix_type = classify_mix_type(key_a, key_b)
-    base = MIX_SCORES.get(mix_type, 0.0) * 10.0  # Amplify harmonic score
 
-    if bpm_a is None or bpm_b is None:
-        bpm_penalty = 0.0
-    else:
-        bpm_diff = abs(bpm_b - bpm_a)
-        bpm_penalty = bpm_diff * weight_bpm
+def transition_score_matrix(bpms, keys, weight_bpm=WEIGHT_BPM):
+    """S[a, b] = transition score a → b for every pair of songs (float32)."""
+    return transition_scores(
+        bpms[:, None], keys[:, None], bpms[None, :], keys[None, :],
+        SCORE_TABLE, weight_bpm, False
+    ).astype(np.float32)
 
-    score = base - bpm_penalty
-    return score, mix_type
 
-def build_harmonic_path(songs):
+def build_harmonic_path(songs, use_two_opt=False):
     """
     Build a "good enough" harmonic-first path using a greedy strategy:
     - Start from the lowest BPM song.
     - At each step, among remaining songs, choose the best-scoring transition.
+    - Optionally (use_two_opt) refine the greedy path with 2-opt moves.
     """
     if not songs:
         return []
@@ -60,44 +43,23 @@ def build_harmonic_path(songs):
         key=lambda s: (float("inf") if s.get("bpm") is None else s["bpm"])
     )
 
-    # Index-based operations
-    remaining_indices = list(range(len(songs_sorted)))
-    path_indices = []
+    # Parse bpm/key once; the greedy loop only touches these parallel arrays
+    bpms, keys = precompute(songs_sorted)
 
     # Start from the lowest BPM with valid key
-    start_idx = None
-    for idx in remaining_indices:
-        if songs_sorted[idx].get("key"):
-            start_idx = idx
-            break
-    if start_idx is None:
+    with_key = np.flatnonzero(keys != UNKNOWN_KEY_CODE)
+    if with_key.size == 0:
         # no song with key → just return the BPM-sorted order
         return songs_sorted
 
-    path_indices.append(start_idx)
-    remaining_indices.remove(start_idx)
+    start_idx = int(with_key[0])
 
     # Greedy extension of the path
-    while remaining_indices:
-        current_idx = path_indices[-1]
-        current_song = songs_sorted[current_idx]
-
-        best_next_idx = None
-        best_score = float("-inf")
-        best_type = None
+    path_indices = greedy_path(bpms, keys, SCORE_TABLE, WEIGHT_BPM, start_idx, False).tolist()
 
-        for idx in remaining_indices:
-            candidate = songs_sorted[idx]
-            score, mix_type = transition_score(current_song, candidate)
-
-            # Prefer higher score; in case of tie, prefer closer BPM
-            if score > best_score:
-                best_score = score
-                best_next_idx = idx
-                best_type = mix_type
-
-        path_indices.append(best_next_idx)
-        remaining_indices.remove(best_next_idx)
+    # Optional 2-opt refinement over the full N×N score matrix
+    if use_two_opt:
+        path_indices = two_opt(path_indices, transition_score_matrix(bpms, keys)).tolist()
 
     # Rebuild ordered list
     ordered_songs = [songs_sorted[i] for i in path_indices]
@@ -132,6 +94,11 @@ def main():
         required=False,
         help="Output JSON for the mixed playlist (default: input name + '_mixed.json')."
     )
+    parser.add_argument(
+        "--two-opt",
+        action="store_true",
+        help="Refine the greedy order with 2-opt (better transitions, ~2x slower)."
+    )
 
     args = parser.parse_args()
 
@@ -152,7 +119,7 @@ def main():
         print(f"  → {len(missing)} songs skipped (missing BPM or key).")
 
     # Compute final harmonic-first ordering
-    ordered = build_harmonic_path(usable)
+    ordered = build_harmonic_path(usable, use_two_opt=args.two_opt)
 
     # Build clean output (no transitions)
     mixed_output = make_clean_output(ordered)
@@ -170,8 +137,7 @@ def main():
         os.makedirs(out_dir, exist_ok=True)
 
     # Save the CLEAN mix
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(mixed_output, f, indent=2, ensure_ascii=False)
+    write_json(output_path, mixed_output)
 
     print(f"\n✨ Harmonic-first mix saved → {output_path}")
     print(f"Tracks included: {len(mixed_output)}")
@@ -0,0 +1,230 @@
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _greedy_path(bpms, key_codes, score_table, w_bpm, start, bpm_first):
+    """
+    Greedy path over precomputed arrays (see camelot_utilities.precompute).
+    - bpm_first=True:  score = max(0, 10 - |Δbpm|) * w_bpm + harmonic * (1 - w_bpm)
+    - bpm_first=False: score = harmonic * 10 - |Δbpm| * w_bpm
+    A missing BPM (NaN) on either side adds nothing to the score.
+    Ties keep the lowest index, like the NumPy argmax path.
+    Returns the visiting order as an int64 array.
+    """
+    n = bpms.shape[0]
+    path = np.empty(n, dtype=np.int64)
+    active = np.ones(n, dtype=np.bool_)
+
+    path[0] = start
+    active[start] = False
+
+    for step in range(1, n):
+        curr = path[step - 1]
+        curr_bpm = bpms[curr]
+        curr_code = key_codes[curr]
+
+        best_idx = -1
+        best_score = -np.inf
+
+        for j in range(n):
+            if not active[j]:
+                continue
+
+            harmonic = np.float64(score_table[curr_code, key_codes[j]])
+            no_bpm = np.isnan(curr_bpm) or np.isnan(bpms[j])
+            diff = 0.0 if no_bpm else abs(bpms[j] - curr_bpm)
+
+            if bpm_first:
+                bpm_score = 0.0 if no_bpm else max(0.0, 10.0 - diff)
+                score = bpm_score * w_bpm + harmonic * (1 - w_bpm)
+            else:
+                score = harmonic * 10.0 - diff * w_bpm
+
+            if score > best_score:
+                best_score = score
+                best_idx = j
+
+        path[step] = best_idx
+        active[best_idx] = False
+
+    return path
+
+
+def transition_scores(bpm_a, code_a, bpms, key_codes, score_table, w_bpm, bpm_first):
+    """
+    Vectorized form of the _greedy_path scores: from one song (bpm_a, code_a)
+    to every song of the parallel `bpms` / `key_codes` arrays (float64).
+    Broadcasts, so column/row arrays give the full N×N matrix.
+    """
+    harmonic = score_table[code_a, key_codes].astype(np.float64)
+
+    if bpm_first:
+        # fmax ignores NaN, so a missing BPM on either side scores 0
+        bpm_score = np.fmax(0.0, 10.0 - np.abs(bpms - bpm_a))
+        return bpm_score * w_bpm + harmonic * (1 - w_bpm)
+
+    # NaN (missing BPM on either side) → no penalty
+    return harmonic * 10.0 - np.nan_to_num(np.abs(bpms - bpm_a) * w_bpm)
+
+
+def _greedy_path_numpy(bpms, key_codes, score_table, w_bpm, start, bpm_first):
+    """NumPy fallback for _greedy_path: same picks, each step scored at once."""
+    n = bpms.shape[0]
+    path = np.empty(n, dtype=np.int64)
+    active = np.ones(n, dtype=bool)
+
+    path[0] = start
+    active[start] = False
+
+    for step in range(1, n):
+        curr = path[step - 1]
+        scores = transition_scores(
+            bpms[curr], key_codes[curr], bpms, key_codes, score_table, w_bpm, bpm_first
+        )
+        scores[~active] = -np.inf
+
+        # argmax keeps the lowest index on ties, like _greedy_path
+        path[step] = scores.argmax()
+        active[path[step]] = False
+
+    return path
+
+
+def _edge_prefix_sums(path, score_matrix, fwd, bwd):
+    """
+    fwd[k] = sum of S[path[e], path[e+1]] for edges e < k (path as is),
+    bwd[k] = same with every edge reversed.
+    """
+    for k in range(path.shape[0] - 1):
+        fwd[k + 1] = fwd[k] + score_matrix[path[k], path[k + 1]]
+        bwd[k + 1] = bwd[k] + score_matrix[path[k + 1], path[k]]
+
+
+def _two_opt(path, score_matrix, max_passes):
+    """
+    2-opt improvement of an open path (the first song stays in place),
+    maximizing the sum of score_matrix[a, b] over consecutive songs.
+    Reversing path[i..j] also flips every edge inside the segment, which
+    matters because transition scores are directional (e.g. energy boost).
+    For each i, the best j is applied if it improves the total.
+    """
+    n = path.shape[0]
+    path = path.copy()
+    fwd = np.zeros(n, dtype=np.float64)
+    bwd = np.zeros(n, dtype=np.float64)
+    _edge_prefix_sums(path, score_matrix, fwd, bwd)
+
+    for _ in range(max_passes):
+        improved = False
+
+        for i in range(1, n - 1):
+            prev = path[i - 1]
+            old_left = np.float64(score_matrix[prev, path[i]])
+
+            best_j = -1
+            best_delta = 1e-6
+
+            for j in range(i + 1, n):
+                delta = np.float64(score_matrix[prev, path[j]]) - old_left
+                delta += (bwd[j] - bwd[i]) - (fwd[j] - fwd[i])
+                if j < n - 1:
+                    nxt = path[j + 1]
+                    delta += np.float64(score_matrix[path[i], nxt])
+                    delta -= np.float64(score_matrix[path[j], nxt])
+
+                if delta > best_delta:
+                    best_delta = delta
+                    best_j = j
+
+            if best_j >= 0:
+                path[i:best_j + 1] = path[i:best_j + 1][::-1].copy()
+                _edge_prefix_sums(path, score_matrix, fwd, bwd)
+                improved = True
+
+        if not improved:
+            break
+
+    return path
+
+
+def _two_opt_numpy(path, score_matrix, max_passes):
+    """NumPy fallback for _two_opt: same moves, the j scan is vectorized."""
+    n = path.shape[0]
+    path = path.copy()
+    S = score_matrix.astype(np.float64)
+
+    def prefix_sums(p):
+        zero = np.zeros(1)
+        fwd = np.concatenate((zero, np.cumsum(S[p[:-1], p[1:]])))
+        bwd = np.concatenate((zero, np.cumsum(S[p[1:], p[:-1]])))
+        return fwd, bwd
+
+    fwd, bwd = prefix_sums(path)
+
+    for _ in range(max_passes):
+        improved = False
+
+        for i in range(1, n - 1):
+            prev = path[i - 1]
+            js = np.arange(i + 1, n)
+
+            delta = S[prev, path[js]] - S[prev, path[i]]
+            delta += (bwd[js] - bwd[i]) - (fwd[js] - fwd[i])
+            inner = js[:-1]
+            nxt = path[inner + 1]
+            delta[:-1] += S[path[i], nxt] - S[path[inner], nxt]
+
+            k = int(delta.argmax())
+            if delta[k] > 1e-6:
+                j = int(js[k])
+                path[i:j + 1] = path[i:j + 1][::-1].copy()
+                fwd, bwd = prefix_sums(path)
+                improved = True
+
+        if not improved:
+            break
+
+    return path
+
+
+if NUMBA_AVAILABLE:
+    _greedy_path = njit(cache=True)(_greedy_path)
+    _edge_prefix_sums = njit(cache=True)(_edge_prefix_sums)
+    _two_opt = njit(cache=True)(_two_opt)
+
+    # Warm up: compile (or load from cache) once at import, not on first mix
+    _greedy_path(
+        np.zeros(2, dtype=np.float64),
+        np.zeros(2, dtype=np.int8),
+        np.zeros((2, 2), dtype=np.float32),
+        0.5, 0, True,
+    )
+
+
+def greedy_path(bpms, key_codes, score_table, w_bpm, start, bpm_first):
+    """
+    Greedy visiting order (int64 array) starting from `start`, see _greedy_path.
+    Uses the compiled kernel when numba is installed, else the NumPy fallback.
+    """
+    if NUMBA_AVAILABLE:
+        return _greedy_path(bpms, key_codes, score_table, w_bpm, start, bpm_first)
+    return _greedy_path_numpy(bpms, key_codes, score_table, w_bpm, start, bpm_first)
+
+
+def two_opt(path, score_matrix, max_passes=50):
+    """
+    Improve a path (e.g. the greedy one) with 2-opt moves.
+    path: int64 array of song indices; score_matrix: float32 N×N,
+    score_matrix[a, b] = score of the transition a → b.
+    """
+    path = np.asarray(path, dtype=np.int64)
+    if path.shape[0] < 3:
+        return path
+    if NUMBA_AVAILABLE:
+        return _two_opt(path, score_matrix, max_passes)
+    return _two_opt_numpy(path, score_matrix, max_passes)
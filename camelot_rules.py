@@ -1,3 +1,5 @@
+import numpy as np
+
 from camelot_utilities import *
 
 def is_perfect_mix(k1, k2):
@@ -103,3 +105,32 @@ def classify_mix_type(k1, k2):
         return "jaws mix"
 
     return "non-harmonic"
+
+
+# ------------------ Precomputed tables ------------------ #
+
+MIX_SCORES = {
+    "perfect mix": 5.0,
+    "+1 mix": 4.0,
+    "-1 mix": 4.0,
+    "energy boost": 3.0,
+    "scale change": 3.0,
+    "diagonal mix": 2.0,
+    "mood shifter": 2.0,
+    "jaws mix": 1.0,
+    "non-harmonic": 0.0,
+    "unknown": 0.0,
+}
+
+# Indexed by key codes (see camelot_code); the extra last row/column is
+# UNKNOWN_KEY_CODE, so a missing key simply scores "unknown".
+N_CODES = UNKNOWN_KEY_CODE + 1
+
+# SCORE_TABLE[a, b] = MIX_SCORES value of the transition a → b
+SCORE_TABLE = np.empty((N_CODES, N_CODES), dtype=np.float32)
+for _a in range(N_CODES):
+    for _b in range(N_CODES):
+        SCORE_TABLE[_a, _b] = MIX_SCORES[
+            classify_mix_type(code_to_camelot(_a), code_to_camelot(_b))
+        ]
+del _a, _b
@@ -1,3 +1,16 @@
+import json
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Integer code for a missing/unparseable key (real keys use 0–23)
+UNKNOWN_KEY_CODE = 24
+
+
 def parse_camelot(key):
     """
     Key is like '9A' or '11B'
@@ -13,3 +26,48 @@ def camelot_increment(num, step):
     Circular increment: numbers 1–12 wrap around.
     """
     return ((num - 1 + step) % 12) + 1
+
+
+def camelot_code(key):
+    """
+    Compact integer code for a Camelot key: (num - 1) * 2 + (0 for A, 1 for B).
+    Example: '1A' → 0, '1B' → 1, '12B' → 23.
+    None and keys outside 1A–12B (e.g. an OCR'd '13A' or '0A') → UNKNOWN_KEY_CODE.
+    """
+    if not key:
+        return UNKNOWN_KEY_CODE
+    num, letter = parse_camelot(key)
+    if not 1 <= num <= 12 or letter not in ("A", "B"):
+        return UNKNOWN_KEY_CODE
+    return (num - 1) * 2 + (0 if letter == "A" else 1)
+
+
+def code_to_camelot(code):
+    """Inverse of camelot_code (UNKNOWN_KEY_CODE → None)."""
+    if code == UNKNOWN_KEY_CODE:
+        return None
+    return f"{code // 2 + 1}{'AB'[code % 2]}"
+
+
+def precompute(songs):
+    """
+    Parse every song once into two parallel arrays:
+    - bpms: float64 (NaN when bpm is missing)
+    - keys: int8 Camelot codes (UNKNOWN_KEY_CODE when key is missing)
+    """
+    bpms = np.array(
+        [np.nan if s.get("bpm") is None else s["bpm"] for s in songs],
+        dtype=np.float64,
+    )
+    keys = np.array([camelot_code(s.get("key")) for s in songs], dtype=np.int8)
+    return bpms, keys
+
+
+def write_json(path, obj):
+    """Write obj as indented UTF-8 JSON (orjson when installed, else stdlib json)."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
@@ -2,19 +2,36 @@
 import os
 import json
 import re
-from difflib import SequenceMatcher
 import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 import numpy as np
-from PIL import Image
 import easyocr
+import torch
+from rapidfuzz import fuzz, process
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # ---------- OCR SETUP ----------
 OUTPUT_DIR = "outputs"
-reader = easyocr.Reader(['en'], gpu=False)
+reader = None  # one easyocr.Reader per OCR worker process (not picklable)
+MIN_ROWS_PER_WORKER = 200  # below this, matching runs in-process
 # --------------------------------
 
+_BPM_RE = re.compile(r'(\d{2,3})\s*bpm')
+_KEY_RE = re.compile(r'\b([0-1]?[0-9][ab])\b')
+_WORD_SPLIT_RE = re.compile(r'\W+')
+
 
 # ---------- HELPERS ----------
 
@@ -31,93 +48,202 @@ def load_songs(path):
 
 def group_by_rows(ocr_items):
     """Regroupe les boxes OCR par lignes."""
-    entries = []
+    boxes = []
+    texts = []
     for item in ocr_items:
         if isinstance(item, (list, tuple)) and len(item) >= 2:
             box, text = item[0], item[1]
             if isinstance(text, str):
-                entries.append((box, text))
+                boxes.append(box)
+                texts.append(text)
 
-    # Sort by Y position
-    entries.sort(key=lambda x: x[0][0][1])
+    if not texts:
+        return []
 
-    rows = []
-    current = []
-    last_y = None
     threshold = 60
 
-    for box, text in entries:
-        y1 = box[0][1]
-        y2 = box[2][1]
-        yc = (y1 + y2) / 2
+    # Sort by Y center; a new row starts at every gap >= threshold
+    ys = np.array([(box[0][1] + box[2][1]) / 2 for box in boxes], dtype=np.float64)
+    order = np.argsort(ys, kind="stable")
+    breaks = np.flatnonzero(np.diff(ys[order]) >= threshold) + 1
 
-        if last_y is None or abs(yc - last_y) < threshold:
-            current.append(text)
-        else:
-            if current:
-                rows.append(" ".join(current))
-            current = [text]
+    return [" ".join(texts[i] for i in group) for group in np.split(order, breaks)]
+
+
+def init_ocr_worker(gpu=False):
+    """Charge le modèle EasyOCR une seule fois par process worker."""
+    global reader
+
+    if not gpu:
+        # One process per core already: keep torch from oversubscribing the CPU
+        torch.set_num_threads(1)
+    reader = easyocr.Reader(['en'], gpu=gpu)
 
-        last_y = yc
 
-    if current:
-        rows.append(" ".join(current))
+def ocr_one(path):
+    """OCR d'une capture → lignes de texte (exécuté dans un worker)."""
+    # EasyOCR reads the file itself: no PIL decode + numpy copy here
+    ocr_raw = reader.readtext(path, detail=1)
 
-    return rows
+    ocr_items = [(item[0], item[1]) for item in ocr_raw if len(item) >= 2]
+    return group_by_rows(ocr_items)
 
 
 def extract_features(text):
     """Extrait BPM et Key."""
     t = text.lower()
 
-    m_bpm = re.search(r'(\d{2,3})\s*bpm', t)
+    m_bpm = _BPM_RE.search(t)
     bpm = int(m_bpm.group(1)) if m_bpm else None
 
-    m_key = re.search(r'\b([0-1]?[0-9][ab])\b', t)
+    m_key = _KEY_RE.search(t)
     key = m_key.group(1).upper() if m_key else None
 
     return bpm, key
 
 
-def similarity(a, b):
-    return SequenceMatcher(None, a, b).ratio()
+def build_song_index(songs):
+    """
+    Précalcule, une fois par chanson :
+    - le texte "titre artiste" en minuscules (pour le fuzzy-match)
+    - les mots du titre (>= 3 lettres) pour rejeter les faux matchs
+    """
+    song_low = [(s["song"] + " " + s.get("artist", "")).lower() for s in songs]
+    song_title_tokens = [
+        frozenset(t for t in _WORD_SPLIT_RE.split(s["song"].lower()) if len(t) >= 3)
+        for s in songs
+    ]
+    return song_low, song_title_tokens
 
 
-def best_song_match(row_text, songs, min_score=0.35):
-    """Fuzzy-match row → best song in library."""
-    row = row_text.lower()
+def build_title_index(song_title_tokens):
+    """
+    Automate Aho–Corasick (mot du titre → chansons) + chansons sans mot de titre.
+    Renvoie None si pyahocorasick n'est pas installé (ou aucun mot).
+    """
+    if ahocorasick is None or not any(song_title_tokens):
+        return None
+
+    automaton = ahocorasick.Automaton()
+    untitled = []
+    for i, tokens in enumerate(song_title_tokens):
+        if not tokens:
+            untitled.append(i)
+        for tok in tokens:
+            if tok in automaton:
+                automaton.get(tok).append(i)
+            else:
+                automaton.add_word(tok, [i])
+    automaton.make_automaton()
 
-    best_idx = None
-    best_score = 0
+    return automaton, untitled
 
-    for i, s in enumerate(songs):
-        title = s["song"]
-        artist = s.get("artist", "")
-        cand = (title + " " + artist).lower()
 
-        score = similarity(row, cand)
-        if score > best_score:
-            best_score = score
-            best_idx = i
+def best_song_match(row_text, song_low, song_title_tokens, needs=None, title_index=None,
+                    min_score=0.35):
+    """
+    Fuzzy-match row → best song in library.
+    needs: optional bool mask, only songs still missing bpm/key are considered.
+    title_index: optional build_title_index() result, finds the title words
+    present in the row in one scan instead of testing every song.
+    """
+    row = row_text.lower()
+
+    # Cheap prefilter (also rejects fake artist-only matches):
+    # a song is only a candidate if one of its title words appears in the row
+    if title_index is not None:
+        automaton, untitled = title_index
+        hits = {i for _, song_ids in automaton.iter(row) for i in song_ids}
+        hits.update(untitled)
+        candidates = {
+            i: song_low[i] for i in sorted(hits)
+            if needs is None or needs[i]
+        }
+    else:
+        indices = range(len(song_low)) if needs is None else np.flatnonzero(needs).tolist()
+        candidates = {
+            i: song_low[i] for i in indices
+            if not song_title_tokens[i] or any(tok in row for tok in song_title_tokens[i])
+        }
+
+    match = process.extractOne(
+        row, candidates, scorer=fuzz.ratio, score_cutoff=min_score * 100
+    )
 
     # Too weak match → reject
-    if best_idx is None or best_score < min_score:
-        return None, best_score
+    if match is None:
+        return None, 0.0
 
-    # Reject fake artist-only matches
-    title_tokens = [w for w in re.split(r'\W+', songs[best_idx]["song"].lower()) if len(w) >= 3]
-    if title_tokens and not any(tok in row for tok in title_tokens):
-        return None, best_score
+    _, score, best_idx = match
+    best_score = score / 100.0
 
     return best_idx, best_score
 
 
+# ---------- MATCHING WORKERS ----------
+
+match_state = None  # immutable matching data, loaded once per worker process
+
+
+def apply_match(song, bpm, key):
+    """Remplit bpm/key manquants de la chanson (premier arrivé gagne)."""
+    updated = False
+
+    if bpm is not None and song.get("bpm") is None:
+        song["bpm"] = bpm
+        updated = True
+    if key is not None and song.get("key") is None:
+        song["key"] = key
+        updated = True
+
+    return updated
+
+
+def init_match_worker(song_low, song_title_tokens, has_bpm, has_key):
+    """Charge les données de matching une seule fois par process worker."""
+    global match_state
+    title_index = build_title_index(song_title_tokens)
+    match_state = (song_low, song_title_tokens, title_index, has_bpm, has_key)
+
+
+def match_chunk(rows):
+    """
+    Matche un lot de lignes (text, bpm, key) → liste de (ligne, song_idx),
+    dans l'ordre des lignes. Les chansons complétées dans ce lot sortent des
+    candidats, comme en séquentiel.
+    """
+    song_low, song_title_tokens, title_index, has_bpm, has_key = match_state
+    has_bpm = has_bpm.copy()
+    has_key = has_key.copy()
+    needs = ~(has_bpm & has_key)
+
+    updates = []
+    for row in rows:
+        if not needs.any():
+            break
+
+        row_text, bpm, key = row
+        idx, score = best_song_match(
+            row_text, song_low, song_title_tokens, needs, title_index
+        )
+        if idx is None:
+            continue
+
+        updates.append((row, idx))
+        has_bpm[idx] |= bpm is not None
+        has_key[idx] |= key is not None
+        needs[idx] = not (has_bpm[idx] and has_key[idx])
+
+    return updates
+
+
 # ---------- MAIN SCRIPT ----------
 
 def main():
     parser = argparse.ArgumentParser(description="Extract BPM/Key from Spotify screenshots")
     parser.add_argument("--screenshots", required=True, help="Folder with screenshots")
     parser.add_argument("--songs", required=True, help="JSON file with song list")
+    parser.add_argument("--gpu", action="store_true", help="Run EasyOCR on a CUDA GPU")
 
     args = parser.parse_args()
 
@@ -158,45 +284,72 @@ def main():
     ])
 
     # Collect OCR lines from ALL screenshots before matching
-    all_rows = []
-    for fname in images:
-        img = Image.open(os.path.join(SCREENSHOT_DIR, fname))
-        ocr_raw = reader.readtext(np.array(img), detail=1)
+    # (screenshots are OCR'd in parallel, one EasyOCR reader per worker;
+    #  on GPU a single worker keeps one model in VRAM)
+    img_paths = [os.path.join(SCREENSHOT_DIR, fname) for fname in images]
+    if args.gpu:
+        n_workers = 1
+    else:
+        n_workers = max(1, min(os.cpu_count() or 1, len(img_paths)))
 
-        ocr_items = [(item[0], item[1]) for item in ocr_raw if len(item) >= 2]
-        rows = group_by_rows(ocr_items)
-
-        for r in rows:
-            r_clean = " ".join(r.split())
-            low = r_clean.lower()
-            all_rows.append(r_clean)
-
-    print(f"\n📝 Extracted {len(all_rows)} candidate rows across screenshots")
+    all_rows = []
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=init_ocr_worker, initargs=(args.gpu,)
+    ) as ex:
+        for rows in ex.map(ocr_one, img_paths):
+            for r in rows:
+                r_clean = " ".join(r.split())
+
+                # Only rows carrying a BPM or key are worth matching
+                bpm, key = extract_features(r_clean)
+                if bpm is not None or key is not None:
+                    all_rows.append((r_clean, bpm, key))
+
+    print(f"\n📝 Extracted {len(all_rows)} candidate rows with BPM/key across screenshots")
     print("🔎 Matching rows to songs...\n")
 
-    # ---------- PROGRESS BAR MATCHING ----------
-    for row_text in tqdm(all_rows, desc="Matching", ncols=90):
-
-        bpm, key = extract_features(row_text)
-        if bpm is None and key is None:
-            continue
-
-        idx, score = best_song_match(row_text, songs)
-        if idx is None:
-            continue
+    song_low, song_title_tokens = build_song_index(songs)
 
-        s = songs[idx]
-        updated = False
+    def match_args():
+        has_bpm = np.array([s["bpm"] is not None for s in songs], dtype=bool)
+        has_key = np.array([s["key"] is not None for s in songs], dtype=bool)
+        return song_low, song_title_tokens, has_bpm, has_key
 
-        if bpm is not None and s.get("bpm") is None:
-            s["bpm"] = bpm
-            updated = True
-        if key is not None and s.get("key") is None:
-            s["key"] = key
-            updated = True
+    # ---------- PROGRESS BAR MATCHING ----------
+    # Rows are independent: split them across processes when there are enough
+    n_workers = max(1, min(os.cpu_count() or 1, len(all_rows) // MIN_ROWS_PER_WORKER))
+
+    if n_workers == 1:
+        init_match_worker(*match_args())
+        results = [match_chunk(tqdm(all_rows, desc="Matching", ncols=90))]
+    else:
+        bounds = np.linspace(0, len(all_rows), n_workers + 1).astype(int)
+        chunks = [all_rows[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+        with ProcessPoolExecutor(
+            max_workers=n_workers, initializer=init_match_worker, initargs=match_args()
+        ) as ex:
+            results = list(tqdm(
+                ex.map(match_chunk, chunks), total=len(chunks), desc="Matching", ncols=90
+            ))
+
+    # Merge in row order: the first row that fills a value wins
+    retry = []
+    for updates in results:
+        for row, idx in updates:
+            _, bpm, key = row
+            if apply_match(songs[idx], bpm, key):
+                matched[idx] = True
+            else:
+                retry.append(row)
 
-        if updated:
-            matched[idx] = True
+    # Rows whose song was already filled by an earlier chunk: re-match them
+    # against what is still missing, as the sequential loop would have
+    if n_workers > 1 and retry:
+        init_match_worker(*match_args())
+        for (_, bpm, key), idx in match_chunk(retry):
+            if apply_match(songs[idx], bpm, key):
+                matched[idx] = True
 
     # ---------- SUMMARY ----------
     total = len(songs)
@@ -228,36 +381,47 @@ def main():
     # generate unique file name in outputs/
     output_path = generate_unique_filename(OUTPUT_DIR, base_name, ".json")
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(songs, f, indent=2, ensure_ascii=False)
+    write_json(output_path, songs)
 
     print(f"\n✨ DONE! Saved: {OUTPUT_FILE}")
 
+def write_json(path, obj):
+    """Écrit obj en JSON indenté UTF-8 (orjson si installé, sinon json)."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, indent=2, ensure_ascii=False)
+
 def generate_unique_filename(folder, base_name, extension=".json"):
     """
-    Returns a unique filename inside `folder` by appending _1, _2, _3… if needed.
+    Returns a unique filename inside `folder`, reserved atomically (O_EXCL).
+    If the plain name is taken, a millisecond timestamp is appended instead
+    of probing _1, _2, _3… one by one.
     Example:
         base_name = "songs_features"
         → songs_features.json
-        → songs_features_1.json
-        → songs_features_2.json
+        → songs_features_1718000000123.json
     """
     # Clean extension
     if not extension.startswith("."):
         extension = "." + extension
 
-    # First candidate
-    filename = f"{base_name}{extension}"
-    full_path = os.path.join(folder, filename)
-
-    # If exists → iterate
-    counter = 1
-    while os.path.exists(full_path):
-        filename = f"{base_name}_{counter}{extension}"
-        full_path = os.path.join(folder, filename)
-        counter += 1
+    os.makedirs(folder, exist_ok=True)
 
-    return full_path
+    # First candidate
+    full_path = os.path.join(folder, f"{base_name}{extension}")
+    stamp = int(time.time() * 1000)
+
+    # Create the file exclusively: no exists() race, one syscall per attempt
+    while True:
+        try:
+            os.close(os.open(full_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return full_path
+        except FileExistsError:
+            full_path = os.path.join(folder, f"{base_name}_{stamp}{extension}")
+            stamp += 1
 
 if __name__ == "__main__":
     main()
@@ -10,11 +10,15 @@ import sys
 import time
 import os
 import urllib.parse
+import urllib.error
 import urllib.request
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=20, datefmt='%I:%M:%S', format='[%(asctime)s] %(message)s')
 
+_UNSAFE_FILENAME_RE = re.compile(r'[\\/*?:"<>|]')
+
 
 # ================================================================
 #                         SPOTIFY API WRAPPER
@@ -48,24 +52,95 @@ class SpotifyAPI:
 
         sys.exit(1)
 
+    # ------------------------------------------------------------
+    # Cheap token check: GET /me, without exiting on failure
+    # ------------------------------------------------------------
+    def is_valid(self, tries=2):
+        for _ in range(tries):
+            try:
+                req = urllib.request.Request("https://api.spotify.com/v1/me")
+                req.add_header("Authorization", "Bearer " + self._auth)
+                urllib.request.urlopen(req).close()
+                return True
+
+            except urllib.error.HTTPError as err:
+                if err.code == 401:
+                    return False
+                logging.info(f"Could not validate token ({err}), retrying...")
+
+            except Exception as err:
+                logging.info(f"Could not validate token ({err}), retrying...")
+
+        return False
+
     # ------------------------------------------------------------
     # Spotify pagination handler
     # ------------------------------------------------------------
     def list(self, url, params={}):
-        last_log = time.time()
         response = self.get(url, params)
         items = response["items"]
 
+        # Offset-paginated endpoints report "total": fetch all remaining
+        # pages concurrently instead of walking response["next"]
+        if response["next"] and response.get("total") is not None:
+            limit = response["limit"]
+            offsets = range(response.get("offset", 0) + limit, response["total"], limit)
+            logging.info(f"Loading {response['total']} items in {len(offsets) + 1} pages")
+
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                pages = ex.map(lambda o: self.get(url, {**params, "offset": o}), offsets)
+                for page in pages:
+                    items += page["items"]
+
+            return items
+
+        # Sequential fallback (e.g. cursor-based pagination)
+        last_log = time.time()
         while response["next"]:
             if time.time() > last_log + 15:
                 last_log = time.time()
-                logging.info(f"Loaded {len(items)}/{response['total']} items")
+                logging.info(f"Loaded {len(items)} items")
 
             response = self.get(response["next"])
             items += response["items"]
 
         return items
 
+    # ------------------------------------------------------------
+    # Token cache (reused across runs until it expires)
+    # ------------------------------------------------------------
+    _TOKEN_CACHE = os.path.expanduser("~/.cache/playlist-organiser/token.json")
+
+    @staticmethod
+    def load_cached_token():
+        try:
+            with open(SpotifyAPI._TOKEN_CACHE, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() >= cached.get("expires_at", 0):
+            return None
+
+        spotify = SpotifyAPI(cached["access_token"])
+        if not spotify.is_valid():
+            return None
+
+        logging.info("Using cached Spotify token")
+        return spotify
+
+    @staticmethod
+    def save_token(access_token, expires_in):
+        os.makedirs(os.path.dirname(SpotifyAPI._TOKEN_CACHE), exist_ok=True)
+
+        # token is a credential: keep the file private to the user
+        fd = os.open(SpotifyAPI._TOKEN_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "access_token": access_token,
+                "expires_at": time.time() + expires_in
+            }, f)
+
     # ------------------------------------------------------------
     # Authorization (Implicit Grant)
     # ------------------------------------------------------------
@@ -89,6 +164,7 @@ class SpotifyAPI:
             while True:
                 server.handle_request()
         except SpotifyAPI._Authorization as auth:
+            SpotifyAPI.save_token(auth.access_token, auth.expires_in)
             return SpotifyAPI(auth.access_token)
 
     _SERVER_PORT = 43019
@@ -117,9 +193,12 @@ class SpotifyAPI:
                 self.wfile.write(b"<script>close()</script>Thanks! You may now close this window.")
 
                 access_token = re.search(r"access_token=([^&]*)", self.path).group(1)
+                expires_in = re.search(r"expires_in=(\d+)", self.path)
                 logging.info(f"Received Spotify token: {access_token}")
 
-                raise SpotifyAPI._Authorization(access_token)
+                raise SpotifyAPI._Authorization(
+                    access_token, int(expires_in.group(1)) if expires_in else 3600
+                )
 
             else:
                 self.send_error(404)
@@ -128,8 +207,29 @@ class SpotifyAPI:
             pass
 
     class _Authorization(Exception):
-        def __init__(self, token):
+        def __init__(self, token, expires_in):
             self.access_token = token
+            self.expires_in = expires_in
+
+
+# ================================================================
+#                           HELPERS
+# ================================================================
+def unique_filename(base, extension):
+    """
+    Reserve base + extension, or base_<ms timestamp> + extension if taken.
+    O_EXCL makes the check-and-create atomic, in one syscall per attempt.
+    """
+    filename = base + extension
+    stamp = int(time.time() * 1000)
+
+    while True:
+        try:
+            os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return filename
+        except FileExistsError:
+            filename = f"{base}_{stamp}{extension}"
+            stamp += 1
 
 
 # ================================================================
@@ -156,7 +256,7 @@ def main():
     if args.token:
         spotify = SpotifyAPI(args.token)
     else:
-        spotify = SpotifyAPI.authorize(
+        spotify = SpotifyAPI.load_cached_token() or SpotifyAPI.authorize(
             client_id="5c098bcc800e45d49e476265bc9b6934",
             scope="playlist-read-private playlist-read-collaborative user-library-read"
         )
@@ -198,16 +298,10 @@ def main():
 
     for playlist in playlists:
         name = playlist["name"]
-        safe_name = re.sub(r'[\\/*?:"<>|]', "_", name).strip()
+        safe_name = _UNSAFE_FILENAME_RE.sub("_", name).strip()
 
         # ensure unique filename
-        filename = safe_name + ".json"
-        base = safe_name
-        counter = 1
-
-        while os.path.exists(filename):
-            filename = f"{base}_{counter}.json"
-            counter += 1
+        filename = unique_filename(safe_name, ".json")
 
         # build cleaned track list
         cleaned = []
@@ -1,69 +1,107 @@
+import asyncio
 import base64
 import hashlib
 import os
 import urllib.parse
-import requests
+from secrets import token_urlsafe
+import httpx
+from aiolimiter import AsyncLimiter
+from rapidfuzz.distance import Levenshtein
 import http.server
 import socketserver
 import webbrowser
 import argparse
 import json
+import re
+import sqlite3
+import threading
 import time
+from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 SCOPES = os.getenv("SPOTIFY_SCOPES")
-AUTH_CODE = None
-CODE_VERIFIER = None
+
+# OAuth callback page bodies, written as-is on every request
+_OK_BODY = b"<h1>Spotify authentication complete!</h1>You may close this window."
+_WAIT_BODY = b"Waiting for Spotify authentication..."
+
+TRACK_RE = re.compile(r"(?:spotify:track:|/track/)([A-Za-z0-9]{22})")
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+TOKEN_REFRESH_MARGIN = 60  # seconds before expiry at which the token is refreshed
+TOKEN_RETRY_DELAY = 5  # seconds between attempts when a refresh request fails
+
+SEARCH_CONCURRENCY = 10  # parallel search requests (stays under Spotify rate limits)
+SEARCH_CACHE_PATH = os.path.expanduser("~/.cache/playlist-organiser/search_cache.sqlite")
+NEGATIVE_CACHE_TTL = 7 * 24 * 3600  # songs not found are searched again after a week
+SEARCH_BATCH_SIZE = 5  # songs ORed into one search request
+MAX_MATCH_DISTANCE = 0.3  # normalized edit distance to accept a batch search result
+
+# Shared token bucket for every API call, sized to Spotify's ~180 requests/minute
+RATE_LIMITER = AsyncLimiter(max_rate=180, time_period=60)
+SERVER_ERROR_RETRIES = 3  # resends of a request answered with a 5xx (1s, 2s, 4s apart)
 
 # ----------------------------------------------
 #  PKCE HELPERS
 # ----------------------------------------------
 def generate_pkce_pair():
-    verifier = base64.urlsafe_b64encode(os.urandom(64)).rstrip(b"=")
-    digest = hashlib.sha256(verifier).digest()
+    verifier = token_urlsafe(64)
+    digest = hashlib.sha256(verifier.encode()).digest()
     challenge = base64.urlsafe_b64encode(digest).rstrip(b"=")
-    return verifier.decode(), challenge.decode()
+    return verifier, challenge.decode()
 
 
 # ----------------------------------------------
 #  OAuth Callback Handler
 # ----------------------------------------------
+class OAuthState:
+    """Authorization code shared between the callback handler and get_spotify_token."""
+    def __init__(self):
+        self.code = None
+        self.done = threading.Event()
+
+
 class OAuthHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
-        global AUTH_CODE
-
         print("\n🔥 CALLBACK:", self.path)
 
         if self.path.startswith("/callback") and "code=" in self.path:
-            AUTH_CODE = self.path.split("code=")[1].split("&")[0]
+            self.server.state.code = self.path.split("code=")[1].split("&")[0]
 
             self.send_response(200)
+            self.send_header("Content-Length", str(len(_OK_BODY)))
             self.end_headers()
-            self.wfile.write(b"<h1>Spotify authentication complete!</h1>You may close this window.")
+            self.wfile.write(_OK_BODY)
+            self.server.state.done.set()
             return
 
         if "favicon" in self.path:
             self.send_response(204)
+            self.send_header("Content-Length", "0")
             self.end_headers()
             return
 
         self.send_response(200)
+        self.send_header("Content-Length", str(len(_WAIT_BODY)))
         self.end_headers()
-        self.wfile.write(b"Waiting for Spotify authentication...")
+        self.wfile.write(_WAIT_BODY)
 
 
 # ----------------------------------------------
 #  Perform OAuth + Token Exchange with PKCE
 # ----------------------------------------------
 def get_spotify_token():
-    global CODE_VERIFIER, AUTH_CODE
-
-    CODE_VERIFIER, code_challenge = generate_pkce_pair()
+    code_verifier, code_challenge = generate_pkce_pair()
 
     auth_url = (
         "https://accounts.spotify.com/authorize?"
@@ -81,22 +119,28 @@ def get_spotify_token():
     webbrowser.open(auth_url)
 
     with socketserver.TCPServer(("127.0.0.1", 9090), OAuthHandler) as httpd:
+        # Serve callbacks on a background thread; the main thread just
+        # blocks until the handler signals that the code has arrived
+        httpd.state = OAuthState()
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
         print("🔌 Waiting for Spotify authentication...")
-        while AUTH_CODE is None:
-            httpd.handle_request()
+        httpd.state.done.wait()
+        httpd.shutdown()
+
+    auth_code = httpd.state.code
 
     print("🔑 Authorization code received, requesting token…")
 
-    token_url = "https://accounts.spotify.com/api/token"
     data = {
         "client_id": CLIENT_ID,
         "grant_type": "authorization_code",
-        "code": AUTH_CODE,
+        "code": auth_code,
         "redirect_uri": REDIRECT_URI,
-        "code_verifier": CODE_VERIFIER
+        "code_verifier": code_verifier
     }
 
-    r = requests.post(token_url, data=data)
+    r = httpx.post(TOKEN_URL, data=data)
     token_info = r.json()
 
     if "error" in token_info:
@@ -104,73 +148,450 @@ def get_spotify_token():
         raise RuntimeError("Could not obtain access token")
 
     print("✅ Access token OK.")
-    return token_info["access_token"]
+    return TokenState(
+        token_info["access_token"],
+        token_info.get("refresh_token"),
+        time.time() + token_info.get("expires_in", 3600)
+    )
+
+
+class TokenState:
+    """Current OAuth tokens; API calls read access_token when they are sent."""
+    def __init__(self, access_token, refresh_token, expires_at):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+
+
+async def keep_token_fresh(token):
+    """
+    Background task: refresh the access token TOKEN_REFRESH_MARGIN seconds
+    before it expires, for as long as the upload runs.
+    """
+    async with httpx.AsyncClient() as client:
+        while token.refresh_token:
+            await asyncio.sleep(max(0, token.expires_at - time.time() - TOKEN_REFRESH_MARGIN))
+
+            try:
+                r = await client.post(TOKEN_URL, data={
+                    "client_id": CLIENT_ID,
+                    "grant_type": "refresh_token",
+                    "refresh_token": token.refresh_token
+                })
+                token_info = r.json()
+            except (httpx.HTTPError, ValueError) as err:
+                # Network error or non-JSON reply: try again shortly
+                print(f"⚠ Token refresh failed ({err}), retrying in {TOKEN_RETRY_DELAY}s...")
+                await asyncio.sleep(TOKEN_RETRY_DELAY)
+                continue
+
+            if "error" in token_info:
+                print("❌ Token refresh failed:", token_info)
+                return
+
+            # Spotify may or may not rotate the refresh token
+            token.access_token = token_info["access_token"]
+            token.refresh_token = token_info.get("refresh_token", token.refresh_token)
+            token.expires_at = time.time() + token_info.get("expires_in", 3600)
+            print("🔑 Access token refreshed.")
+
+
+# --------------------------------------------------------
+# SEARCH CACHE (persistent, keyed on song + artist)
+# --------------------------------------------------------
+class SearchCache:
+    MISS = object()
+
+    def __init__(self, path=SEARCH_CACHE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS uri_cache (key TEXT PRIMARY KEY, track_uri TEXT, ts INTEGER)"
+        )
+        self._memory = {}
+
+    @staticmethod
+    def _key(song, artist):
+        return hashlib.sha1(f"{song}|{artist}".lower().encode()).hexdigest()
+
+    def get(self, song, artist):
+        """Cached track URI, None if known to be missing, SearchCache.MISS if unknown."""
+        key = self._key(song, artist)
+        if key in self._memory:
+            return self._memory[key]
+
+        row = self._db.execute("SELECT track_uri, ts FROM uri_cache WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return SearchCache.MISS
+
+        track_uri, ts = row
+        if track_uri is None and time.time() - ts > NEGATIVE_CACHE_TTL:
+            return SearchCache.MISS
+
+        self._memory[key] = track_uri
+        return track_uri
+
+    def put(self, song, artist, track_uri):
+        key = self._key(song, artist)
+        self._memory[key] = track_uri
+        self._db.execute(
+            "INSERT OR REPLACE INTO uri_cache (key, track_uri, ts) VALUES (?, ?, ?)",
+            (key, track_uri, int(time.time()))
+        )
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+# --------------------------------------------------------
+# LOCAL MATCHING OF SEARCH RESULTS
+# --------------------------------------------------------
+def match_distance(item, song, artist):
+    """Normalized edit distance between a search result and the wanted song/artist."""
+    if not artist:
+        # Unknown artist: only the title can be compared
+        wanted, found = song.lower(), item["name"].lower()
+    else:
+        wanted = f"{song} {artist}".lower()
+        found = (item["name"] + " " + ", ".join(a["name"] for a in item["artists"])).lower()
+    return Levenshtein.normalized_distance(wanted, found)
+
+
+def best_match(items, song, artist):
+    """Closest result to (song, artist), earliest release on ties; None if none is close."""
+    close = []
+    for item in items:
+        distance = match_distance(item, song, artist)
+        if distance <= MAX_MATCH_DISTANCE:
+            release = item["album"].get("release_date") or "9999"
+            close.append((distance, release, item["uri"]))
+
+    return min(close)[2] if close else None
+
 
 # --------------------------------------------------------
 # SPOTIFY HELPERS
 # --------------------------------------------------------
-def spotify_search_track(song, artist, token):
-    query = f"{song} {artist}"
+def spotify_client(token):
+    """
+    One HTTP/2 client for every API call: concurrent requests are
+    multiplexed over a single connection instead of one socket each.
+    The bearer header is built per request, so a refreshed token is used
+    as soon as keep_token_fresh stores it.
+    """
+    def authorize(request):
+        request.headers["Authorization"] = f"Bearer {token.access_token}"
+        return request
+
+    return httpx.AsyncClient(
+        http2=True,
+        auth=authorize,
+        limits=httpx.Limits(max_connections=10),
+    )
+
+
+async def spotify_request(client, method, url, **kwargs):
+    """
+    Send one API request under RATE_LIMITER. On 429, wait for Spotify's
+    Retry-After, then wait for the limiter again before resending.
+    A 5xx is resent up to SERVER_ERROR_RETRIES times with exponential backoff;
+    the last response is returned either way (callers check the status).
+    """
+    server_errors = 0
+    while True:
+        async with RATE_LIMITER:
+            r = await client.request(method, url, **kwargs)
+
+        if r.status_code >= 500 and server_errors < SERVER_ERROR_RETRIES:
+            retry_after = 2 ** server_errors
+            server_errors += 1
+        elif r.status_code == 429:
+            retry_after = int(r.headers.get("Retry-After", "1"))
+        else:
+            return r
+
+        print(f"⏳ Spotify answered {r.status_code}, retrying in {retry_after}s...")
+        await asyncio.sleep(retry_after)
+
+
+def search_field(text):
+    """Song/artist text usable inside a quoted search field filter (None → "")."""
+    return (text or "").replace('"', " ")
+
+
+def field_query(song, artist):
+    """track:"song" artist:"artist" filter; title alone when the artist is unknown."""
+    query = f'track:"{search_field(song)}"'
+    if artist:
+        query += f' artist:"{search_field(artist)}"'
+    return query
+
+
+async def spotify_search_items(client, query, limit):
+    """
+    Track results of one search query. A failed request raises
+    httpx.HTTPStatusError instead of looking like an empty result.
+    """
     url = "https://api.spotify.com/v1/search?" + urllib.parse.urlencode({
         "q": query,
         "type": "track",
-        "limit": 1
+        "limit": limit
     })
 
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"})
-    items = r.json().get("tracks", {}).get("items", [])
-    if items:
-        return items[0]["id"]
+    r = await spotify_request(client, "GET", url)
+    r.raise_for_status()
+    return r.json().get("tracks", {}).get("items", [])
+
+
+async def spotify_search_track(client, song, artist):
+    """
+    Search one song: a field-filtered query whose few results are ranked
+    locally (closest by edit distance, else Spotify's first), and a
+    song-only query only when the first one returns nothing.
+    """
+    items = await spotify_search_items(client, field_query(song, artist), 5)
 
     # fallback (song only)
-    url = "https://api.spotify.com/v1/search?" + urllib.parse.urlencode({
-        "q": song,
-        "type": "track",
-        "limit": 1
-    })
-    r = requests.get(url, headers={"Authorization": f"Bearer {token}"})
-    items = r.json().get("tracks", {}).get("items", [])
+    if not items:
+        items = await spotify_search_items(client, song, 5)
+
     if items:
-        return items[0]["id"]
+        return best_match(items, song, artist) or items[0]["uri"]
 
     return None
 
 
-def get_user_id(token):
-    r = requests.get("https://api.spotify.com/v1/me",
-                     headers={"Authorization": f"Bearer {token}"})
+async def spotify_search_batch(client, pairs):
+    """
+    One search request for several (song, artist) pairs (field filters joined
+    with OR); each pair then picks its closest result locally.
+    Returns track URIs aligned with pairs (None = no close result).
+    """
+    query = " OR ".join(field_query(song, artist) for song, artist in pairs)
+    items = await spotify_search_items(client, query, 50)
+
+    return [best_match(items, song, artist) for song, artist in pairs]
+
+
+def start_searches(client, songs, cache):
+    """
+    Start resolving all songs to track URIs; returns one future per song,
+    in input order, so results can be consumed as soon as they are ready.
+    - Cached results (including "not found") skip the network entirely.
+    - The rest is searched SEARCH_BATCH_SIZE songs per request, concurrently.
+    - Only songs their batch did not resolve get their own per-song search.
+    - A song whose search failed (HTTP or network error) resolves to None
+      for this run but is not cached, so the next run searches it again.
+    Must be called from a running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    # A missing artist (null in the mixers' output) searches by title alone
+    pairs = [(s["song"], s.get("artist") or "") for s in songs]
+    results = []
+    todo = []
+
+    for i, (song, artist) in enumerate(pairs):
+        uri = cache.get(song, artist)
+        if uri is SearchCache.MISS:
+            todo.append(i)
+            results.append(None)  # replaced by its search task below
+        else:
+            results.append(loop.create_future())
+            results[i].set_result(uri)
+
+    async def search_batch(batch):
+        async with semaphore:
+            return await spotify_search_batch(client, [pairs[i] for i in batch])
+
+    async def resolve(i, batch_task, k):
+        try:
+            uri = (await batch_task)[k]
+            if uri is None:
+                async with semaphore:
+                    uri = await spotify_search_track(client, *pairs[i])
+        except httpx.HTTPError as err:
+            print(f"⚠ Search failed for {pairs[i][0]} ({describe_error(err)})")
+            return None
+
+        cache.put(*pairs[i], uri)
+        return uri
+
+    for start in range(0, len(todo), SEARCH_BATCH_SIZE):
+        batch = todo[start:start + SEARCH_BATCH_SIZE]
+        batch_task = asyncio.create_task(search_batch(batch))
+        for k, i in enumerate(batch):
+            results[i] = asyncio.create_task(resolve(i, batch_task, k))
+
+    return results
+
+
+def json_bytes(obj):
+    """Serialize a request body (orjson when installed, else stdlib json)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+async def get_user_id(client):
+    r = await spotify_request(client, "GET", "https://api.spotify.com/v1/me")
+    r.raise_for_status()
     return r.json()["id"]
 
 
-def create_playlist(user_id, name, token):
-    r = requests.post(
+async def create_playlist(client, user_id, name):
+    playlist = await spotify_post(
+        client,
         f"https://api.spotify.com/v1/users/{user_id}/playlists",
-        headers={"Authorization": f"Bearer {token}",
-                 "Content-Type": "application/json"},
-        data=json.dumps({
+        {
             "name": name,
             "description": "Harmonic/ BPM Mix Playlist",
             "public": False
-        })
+        }
     )
-    return r.json()["id"]
+    return playlist["id"]
 
 
-def add_tracks_to_playlist(playlist_id, track_ids, token):
-    for i in range(0, len(track_ids), 100):
-        batch = track_ids[i:i+100]
-        requests.post(
-            f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks",
-            headers={"Authorization": f"Bearer {token}",
-                     "Content-Type": "application/json"},
-            data=json.dumps({"uris": [f"spotify:track:{tid}" for tid in batch]})
-        )
-        time.sleep(0.2)
+def describe_error(err):
+    """Short text for an httpx error: "HTTP <status>" for error replies."""
+    if isinstance(err, httpx.HTTPStatusError):
+        return f"HTTP {err.response.status_code}"
+    return str(err)
+
+
+async def spotify_post(client, url, payload):
+    """
+    POST a JSON payload and return the decoded response.
+    An error reply raises httpx.HTTPStatusError.
+    """
+    r = await spotify_request(
+        client, "POST", url,
+        content=json_bytes(payload), headers={"Content-Type": "application/json"}
+    )
+    r.raise_for_status()
+    return r.json()
+
+
+async def add_tracks_from_queue(client, playlist, queue):
+    """
+    Add the (track URI, song name) pairs arriving on queue (None ends the
+    stream) to the playlist, 100 per request. `playlist` is awaited for the
+    playlist ID. A batch Spotify refuses is reported and skipped.
+    Returns (playlist_id, names of the songs that could not be added).
+    """
+    # Batches are sent one after another: each one is appended at the end of
+    # the playlist, so sending them concurrently would shuffle the mix order.
+    # Pacing comes from RATE_LIMITER and Retry-After, not from a fixed sleep.
+    playlist_id = await playlist
+    url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
+
+    batch = []
+    failed = []
+    while True:
+        track = await queue.get()
+        if track is not None:
+            batch.append(track)
+
+        if batch and (track is None or len(batch) == 100):
+            try:
+                await spotify_post(client, url, {"uris": [uri for uri, _ in batch]})
+            except httpx.HTTPError as err:
+                print(f"❌ Could not add {len(batch)} tracks ({describe_error(err)})")
+                failed.extend(name for _, name in batch)
+            batch = []
+
+        if track is None:
+            return playlist_id, failed
+
+
+async def target_playlist(client, args, user_id_task):
+    if args.playlist_id:
+        print(f"📀 Using EXISTING playlist: {args.playlist_id}")
+        return args.playlist_id
+
+    playlist_name = args.name or os.path.splitext(os.path.basename(args.input))[0]
+    print(f"📀 Creating NEW playlist: {playlist_name}")
+    playlist_id = await create_playlist(client, await user_id_task, playlist_name)
+    print("📀 Playlist created with ID:", playlist_id)
+    return playlist_id
+
+
+def load_songs(path):
+    data = Path(path).read_bytes()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def song_key(s):
+    """Normalized (song, artist) identity used to deduplicate searches."""
+    return (s["song"].strip().lower(), (s.get("artist") or "").strip().lower())
 
 
 # --------------------------------------------------------
 # MAIN UPLOAD LOGIC
 # --------------------------------------------------------
+async def upload_mix(args, songs, token):
+    """
+    Resolve every song and add them, in order, to the target playlist.
+    Searches and inserts overlap: a producer queues URIs in mix order as
+    their searches finish while add_tracks_from_queue posts full batches.
+    Returns (playlist_id, missing song names, song names Spotify refused to add).
+    """
+    refresher = asyncio.create_task(keep_token_fresh(token))
+
+    async with spotify_client(token) as client:
+        # Off the critical path: the user ID is fetched and the playlist
+        # created while the searches run
+        user_id_task = None if args.playlist_id else asyncio.create_task(get_user_id(client))
+        playlist_task = asyncio.create_task(target_playlist(client, args, user_id_task))
+
+        track_uris = [None] * len(songs)
+        to_search = []
+        missing = []
+
+        for i, s in enumerate(songs):
+
+            # --- 1) If URL already exists, build the track URI from its ID ---
+            if s.get("url"):
+                match = TRACK_RE.search(s["url"])
+                if match:
+                    track_uris[i] = "spotify:track:" + match.group(1)
+                    continue  # skip search entirely
+
+            # --- 2) Otherwise: use Spotify search ---
+            to_search.append(i)
+
+        # Deduplicate before any network work: each (song, artist) is searched once
+        unique = {}
+        for i in to_search:
+            unique.setdefault(song_key(songs[i]), songs[i])
+
+        queue = asyncio.Queue()
+
+        async def produce():
+            for i, s in enumerate(songs):
+                uri = track_uris[i] or await searches[song_key(s)]
+                if uri:
+                    await queue.put((uri, s["song"]))
+                else:
+                    missing.append(s["song"])
+            await queue.put(None)
+
+        cache = SearchCache()
+        try:
+            searches = dict(zip(unique, start_searches(client, list(unique.values()), cache)))
+            _, (playlist_id, failed) = await asyncio.gather(
+                produce(), add_tracks_from_queue(client, playlist_task, queue)
+            )
+        finally:
+            cache.close()
+            refresher.cancel()
+
+    return playlist_id, missing, failed
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", required=True, help="JSON mix file")
@@ -182,51 +603,12 @@ def main():
 )
     args = parser.parse_args()
 
-    # load playlist JSON
-    with open(args.input, "r", encoding="utf-8") as f:
-        songs = json.load(f)
+    # load playlist JSON first: a bad --input fails before the browser opens
+    songs = load_songs(args.input)
 
     token = get_spotify_token()
-    user_id = get_user_id(token)
-
-    playlist_name = args.name or os.path.splitext(os.path.basename(args.input))[0]
-    # 4) Determine target playlist
-    if args.playlist_id:
-        playlist_id = args.playlist_id
-        print(f"📀 Using EXISTING playlist: {playlist_id}")
-    else:
-        playlist_name = args.name or os.path.splitext(os.path.basename(args.input))[0]
-        print(f"📀 Creating NEW playlist: {playlist_name}")
-        playlist_id = create_playlist(user_id, playlist_name, token)
-        print("📀 Playlist created with ID:", playlist_id)
-
-    track_ids = []
-    missing = []
-
-    for s in songs:
-
-        # --- 1) If URL already exists, extract track ID ---
-        if s.get("url"):
-            match = None
-            url = s["url"]
-            if "track/" in url:
-                match = url.split("track/")[1].split("?")[0]
-            elif url.startswith("spotify:track:"):
-                match = url.split(":")[-1]
-
-            if match:
-                track_ids.append(match)
-                continue  # skip search entirely
-
-        # --- 2) Otherwise: use Spotify search ---
-        tid = spotify_search_track(s["song"], s["artist"], token)
-        if tid:
-            track_ids.append(tid)
-        else:
-            missing.append(s["song"])
-
 
-    add_tracks_to_playlist(playlist_id, track_ids, token)
+    playlist_id, missing, failed = asyncio.run(upload_mix(args, songs, token))
 
     print("\n✨ Playlist created!")
     print(f"https://open.spotify.com/playlist/{playlist_id}")
@@ -236,6 +618,11 @@ def main():
         for m in missing:
             print("  -", m)
 
+    if failed:
+        print("\n❌ Found but not added (Spotify error):")
+        for m in failed:
+            print("  -", m)
+
 
 if __name__ == "__main__":
     main()